@@ -1,36 +1,105 @@
+import asyncio
+import hmac
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter, HTTPException, Form
 from fastapi.responses import RedirectResponse
 from fastapi import Depends, status
 from fastapi.security import OAuth2PasswordBearer
-from pydantic import BaseModel
-from bson.objectid import ObjectId
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+from passlib.hash import bcrypt
 from db import users_collection
+from user_data import user_cache
 
 router = APIRouter()
 
+# Target cost of a single hash/verify on this host; bcrypt doubles its work per extra round.
+BCRYPT_TARGET_SECONDS = 0.1
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 16
+
+def calibrate_bcrypt_rounds():
+    """
+    Picks the largest bcrypt cost whose hash time stays within BCRYPT_TARGET_SECONDS.
+    """
+    # The first hash also loads passlib's bcrypt backend and runs its self-test, so keep it untimed.
+    bcrypt.using(rounds=4).hash("warm-up")
+    start = time.perf_counter()
+    bcrypt.using(rounds=BCRYPT_MIN_ROUNDS).hash("calibration")
+    elapsed = time.perf_counter() - start
+
+    rounds = BCRYPT_MIN_ROUNDS
+    while rounds < BCRYPT_MAX_ROUNDS and elapsed * 2 <= BCRYPT_TARGET_SECONDS:
+        rounds += 1
+        elapsed *= 2
+    return rounds
+
+BCRYPT_ROUNDS = calibrate_bcrypt_rounds()
+password_hasher = bcrypt.using(rounds=BCRYPT_ROUNDS)
+
+# bcrypt work gets its own pool sized to the CPU count so login bursts don't tie up Starlette's
+# shared threadpool. The bcrypt package releases the GIL while hashing, so threads run in parallel.
+password_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
+
+async def run_in_password_pool(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(password_pool, func, *args)
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+def is_hashed(stored_password):
+    return bool(stored_password) and password_hasher.identify(stored_password)
+
+def verify_password(password, stored_password):
+    """
+    Checks a password against the stored value. Accounts created before hashing was
+    introduced still hold plaintext, which is compared in constant time.
+    """
+    if not stored_password:
+        return False
+    if is_hashed(stored_password):
+        try:
+            return password_hasher.verify(password, stored_password)
+        except ValueError:
+            return False
+    return hmac.compare_digest(password.encode(), stored_password.encode())
+
+async def get_user(username):
+    """
+    Returns the user's auth fields, served from user_cache when possible.
+    """
+    user = user_cache.get(username)
+    if user is None:
+        user = await users_collection.find_one({"username": username}, {"_id": 0, "password": 1})
+        if user is not None:
+            user_cache[username] = user
+    return user
+
 @router.post("/signup")
 async def signup(username: str = Form(...), password: str = Form(...)):
     if users_collection is None:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database not connected.")
 
     try:
-        existing_user = users_collection.find_one({"username": username})
-        if existing_user:
+        hashed = await run_in_password_pool(hash_password, password)
+        # The unique index on username rejects duplicates, so no find_one probe is needed.
+        try:
+            await users_collection.insert_one({
+                "username": username,
+                "password": hashed
+            })
+        except DuplicateKeyError:
             return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
-
-        users_collection.insert_one({
-            "username": username,
-            "password": password
-        })
+        user_cache.pop(username, None)
 
         return RedirectResponse(url=f"/chat?username={username}", status_code=status.HTTP_303_SEE_OTHER)
         
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        print(f"Signup error: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error during signup")
+    except AutoReconnect:
+        # Also covers ServerSelectionTimeoutError; anything else is left to FastAPI's default handler.
+        logging.exception("Signup database error for user=%s", username)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database unavailable during signup")
 
 
 @router.post("/login")
@@ -39,17 +108,21 @@ async def login(username: str = Form(...), password: str = Form(...)):
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database not connected.")
 
     try:
-        user = users_collection.find_one({"username": username, "password": password})
-        if user:
+        user = await get_user(username)
+        # bcrypt is CPU-bound, so verify off the event loop.
+        if user and await run_in_password_pool(verify_password, password, user.get("password")):
+            if not is_hashed(user["password"]):
+                # Upgrade legacy plaintext passwords on first successful login.
+                hashed = await run_in_password_pool(hash_password, password)
+                await users_collection.update_one({"username": username}, {"$set": {"password": hashed}})
+                user_cache.pop(username, None)
             return RedirectResponse(url=f"/chat?username={username}", status_code=status.HTTP_303_SEE_OTHER)
         else:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        print(f"Login error: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error during login")
+    except AutoReconnect:
+        logging.exception("Login database error for user=%s", username)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database unavailable during login")
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
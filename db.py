@@ -1,6 +1,9 @@
+import asyncio
 import certifi
 import os
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
 import logging
 import sys
@@ -31,20 +34,43 @@ elif not MONGO_DB_NAME:
     logging.error("❌ MONGO_DB_NAME environment variable not set. Cannot connect to MongoDB. Exiting.")
     sys.exit(1)
 else:
+    # Motor connects lazily; the connection itself is verified in init_db() on app startup.
+    client = AsyncIOMotorClient(
+        MONGO_URI,
+        tlsCAFile=certifi.where(),
+        maxPoolSize=50,
+        serverSelectionTimeoutMS=5000
+    )
+    db = client[MONGO_DB_NAME]
+    users_collection = db["users"]
+    # History is non-critical chat logging, so writes are fire-and-forget (w=0).
+    history_collection = db.get_collection("history", write_concern=WriteConcern(w=0))
+    hotels_collection = db["hotels"]
+
+
+async def init_db():
+    """
+    Verifies the MongoDB connection and ensures the required indexes exist.
+    Called once from the FastAPI lifespan handler on startup.
+    """
     try:
-        
-        client = MongoClient(
-            MONGO_URI,
-            tlsCAFile=certifi.where(),
-            serverSelectionTimeoutMS=5000 
-        )
-       
-        client.admin.command('ismaster')
-        db = client[MONGO_DB_NAME]
-        users_collection = db["users"]
-        history_collection = db["history"] 
-        hotels_collection = db["hotels"]
-        logging.info("✅ Connected to MongoDB Atlas")
+        await client.admin.command('ismaster')
     except Exception as e:
         logging.error(f"❌ MongoDB connection error: {e}. Please check your MONGO_URI, IP Access List, and network connectivity.")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
+    logging.info("✅ Connected to MongoDB Atlas")
+
+    try:
+        # The index builds are independent, so they run concurrently. History's index goes
+        # through the default (acknowledged) write concern.
+        await asyncio.gather(
+            users_collection.create_index("username", unique=True),
+            db["history"].create_index([("username", 1), ("timestamp", -1)]),
+            db["history"].create_index([("session_id", 1), ("timestamp", -1)])
+        )
+    except DuplicateKeyError as e:
+        logging.error(f"❌ Cannot create the unique username index: {e}. Remove duplicate usernames from the users collection before restarting.")
+        sys.exit(1)
+    except OperationFailure as e:
+        logging.error(f"❌ MongoDB index creation failed: {e}. Check that the database user may create indexes.")
+        sys.exit(1)
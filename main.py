@@ -1,29 +1,60 @@
 import os
+import re
+import asyncio
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Form, Response
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from dotenv import load_dotenv
 from auth import router as auth_router
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 import logging
 from datetime import datetime
-from db import history_collection, hotels_collection, users_collection
+from typing import List, Optional
+from pydantic import BaseModel
+from db import history_collection, hotels_collection, users_collection, init_db
 from twilio.twiml.messaging_response import MessagingResponse
-from user_data import user_sessions, user_selected_hotels
+from bson import ObjectId
+from pymongo import ReturnDocument
+from user_data import ai_enabled_cache, user_sessions, user_selected_hotels
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    await init_db()
+    await load_hotels()
+    writer = asyncio.create_task(history_writer())
+    yield
+    # The sentinel makes the writer flush whatever is still queued before exiting.
+    history_queue.put_nowait(None)
+    await writer
+
+app = FastAPI(lifespan=lifespan)
 
 # Mount static files and templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="static")
+# Templates don't change at runtime, so skip Jinja's per-render mtime check and keep compiled
+# bytecode in the default temp-dir cache across restarts.
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("static"),
+    autoescape=True,
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache()
+))
+
+# login.html has no dynamic content, so it is rendered once at startup. chat.html only
+# varies by username, so its compiled template is kept and the response is browser-cacheable.
+login_page_html = templates.get_template("login.html").render()
+chat_template = templates.get_template("chat.html")
 
 # Include auth routes
 app.include_router(auth_router)
@@ -47,62 +78,295 @@ if gemini_api_key:
         llm = ChatGoogleGenerativeAI(
             model="gemini-1.5-flash",
             google_api_key=gemini_api_key,
-            temperature=0.7
+            temperature=0.7,
+            convert_system_message_to_human=True
         )
         logging.info("✅ Gemini LLM initialized successfully.")
     except Exception as e:
         logging.error(f"❌ Error initializing Gemini LLM: {e}")
         llm = None
 
+# Chat turns are queued and written in batches by history_writer(), keeping the insert
+# off the reply path.
+HISTORY_BATCH_SIZE = 100
+HISTORY_FLUSH_INTERVAL = 0.5  # seconds
+history_queue = asyncio.Queue()
+
+def record_history(entry):
+    history_queue.put_nowait(entry)
+
+def record_turn(username, hotel_name, message, reply, session_id=None):
+    entry = {
+        "username": username,
+        "hotel": hotel_name,
+        "timestamp": datetime.now(),
+        "user_message": message,
+        "bot_response": reply
+    }
+    if session_id is not None:
+        # Only concierge turns carry the session id, which is what the conversation window reads.
+        entry["session_id"] = session_id
+    record_history(entry)
+
+async def history_writer():
+    """
+    Drains history_queue, writing up to HISTORY_BATCH_SIZE entries per insert_many.
+    A batch is flushed when it is full or HISTORY_FLUSH_INTERVAL after its first entry.
+    Exits after flushing once a None sentinel is received.
+    """
+    loop = asyncio.get_running_loop()
+    running = True
+    while running:
+        batch = []
+        entry = await history_queue.get()
+        deadline = loop.time() + HISTORY_FLUSH_INTERVAL
+        while entry is not None:
+            batch.append(entry)
+            if len(batch) >= HISTORY_BATCH_SIZE:
+                break
+            try:
+                entry = await asyncio.wait_for(history_queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+        else:
+            running = False
+
+        if batch:
+            try:
+                await history_collection.insert_many(batch, ordered=False)
+            except Exception as e:
+                logging.error(f"[DB] Failed to write {len(batch)} chat history entries: {e}")
+
+# JSON endpoints declare response models so FastAPI serializes their results straight to bytes
+# via Pydantic; error responses with their own status codes go through JSONResponse.
+class HistoryEntry(BaseModel):
+    user_message: str
+    bot_response: str
+    timestamp: Optional[datetime] = None
+
+class HistoryPage(BaseModel):
+    history: List[HistoryEntry]
+
+class ChatReply(BaseModel):
+    response: str
+
+# Only the fields rendered by the history views are fetched from Mongo.
+HISTORY_PROJECTION = {"_id": 0, "user_message": 1, "bot_response": 1, "timestamp": 1}
+# Maximum number of chat turns returned by the history views.
+HISTORY_PAGE_SIZE = 50
+
+# Phrases that make the user pick a hotel again, matched case-insensitively anywhere in a message.
+RESET_RE = re.compile(r"change hotel|different hotel|try another hotel|switch hotel|reset hotel|choose hotel again", re.IGNORECASE)
+
+# Hotels rarely change, so the collection is cached in-process and refreshed after HOTEL_CACHE_TTL seconds.
+HOTEL_CACHE_TTL = 60
+hotel_cache = {"list_text": None, "by_name": None, "expires": 0}
+
+async def load_hotels():
+    """
+    Returns the hotel cache, reloading it from Mongo once it has expired.
+    Set hotel_cache["expires"] = 0 after changing the hotels collection to force a reload.
+    """
+    if time.monotonic() > hotel_cache["expires"]:
+        hotels = await hotels_collection.find({}, {"_id": 0}).to_list(length=None)
+        hotel_cache.update(
+            list_text="".join(f"\n- {h['hotel_name']}" for h in hotels),
+            by_name={h["hotel_name"].lower(): h for h in hotels},
+            expires=time.monotonic() + HOTEL_CACHE_TTL
+        )
+    return hotel_cache
+
+async def get_hotel_list_text():
+    """
+    Returns the hotel names pre-formatted as a bulleted list, ready to append to a prompt line.
+    """
+    return (await load_hotels())["list_text"]
+
+async def find_hotel(name):
+    """
+    Case-insensitive exact lookup of a hotel by name, served from the hotel cache.
+    """
+    return (await load_hotels())["by_name"].get(name.strip().lower())
+
+# Number of recent exchanges sent to the LLM along with each new message.
+CONVERSATION_WINDOW = 6
+# Number of past exchanges summarized into the hotel context when a conversation starts.
+PAST_CHATS_SUMMARY_SIZE = 5
+
+# Instructions shared by every conversation. Built once and always sent first, unchanged, so
+# Gemini can reuse its cached prompt prefix across requests.
+SYSTEM_PROMPT = SystemMessage(content=(
+    "You are a helpful and polite hotel concierge. Your sole purpose is to assist guests "
+    "with inquiries related to their selected hotel, its amenities, and services. "
+    "Do not answer any questions unrelated to your role or the hotel. If a user asks "
+    "a non-concierge question, politely state that you can only assist with "
+    "hotel-related inquiries. Keep your responses concise and professional."
+))
+
 def build_hotel_prompt(hotel_data):
     hotel_name = hotel_data.get("hotel_name", "Unknown Hotel")
     details = hotel_data.get("details", "No details available.")
     return hotel_name, details
 
-def get_or_create_conversation(username):
+async def touch_user(username):
     """
-    Retrieves a user's conversation or creates a new one if it doesn't exist.
+    Marks the user active and returns their ai_enabled flag in a single round trip,
+    creating the user document on first contact.
     """
-    if username not in user_sessions:
-        if llm is None:
-            return None
-        user_sessions[username] = ConversationChain(
-            llm=llm,
-            memory=ConversationBufferMemory(),
-            verbose=True
-        )
-    return user_sessions[username]
+    return await users_collection.find_one_and_update(
+        {"username": username},
+        {
+            "$set": {"last_active": datetime.utcnow()},
+            "$setOnInsert": {"ai_enabled": True}
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        projection={"_id": 0, "ai_enabled": 1}
+    )
+
+async def get_ai_enabled(username):
+    """
+    Returns the user's ai_enabled flag from ai_enabled_cache, touching the user document only
+    on a miss. last_active is therefore refreshed at most once per cache TTL.
+    """
+    ai_enabled = ai_enabled_cache.get(username)
+    if ai_enabled is None:
+        user = await touch_user(username)
+        ai_enabled = user.get("ai_enabled", True)
+        ai_enabled_cache[username] = ai_enabled
+    return ai_enabled
+
+def refresh_session(username):
+    """
+    Re-inserts the user's session entries so the TTL caches expire idle sessions, not long ones.
+    """
+    user_selected_hotels[username] = user_selected_hotels[username]
+    user_sessions[username] = user_sessions[username]
 
-def initialize_conversation(conversation, hotel_data, past_chats):
+async def get_past_chats(username):
+    """
+    Returns the user's last PAST_CHATS_SUMMARY_SIZE exchanges, oldest first.
+    """
+    cursor = history_collection.find(
+        {"username": username},
+        {"_id": 0, "user_message": 1, "bot_response": 1}
+    ).sort("timestamp", -1).limit(PAST_CHATS_SUMMARY_SIZE)
+    past_chats = await cursor.to_list(length=PAST_CHATS_SUMMARY_SIZE)
+    past_chats.reverse()
+    return past_chats
+
+async def initialize_conversation(username, hotel_data, past_chats):
     """
-    Initializes a specific AI conversation with a constrained prompt for a hotel.
+    Starts a user's conversation for a hotel and returns the AI's greeting. Only the hotel
+    context exchange and a fresh session id are kept in memory; later turns are read from
+    Mongo by that id, so a new visit never replays an earlier one.
     """
-    conversation.memory.clear()
     hotel_name, hotel_details = build_hotel_prompt(hotel_data)
-    
-    # Define the system prompt to constrain the AI's role
-    system_prompt = (
-        f"You are a helpful and polite concierge for {hotel_name}. Your sole purpose is to "
-        f"assist guests with inquiries related to the hotel, its amenities, and services. "
-        f"You have access to the following information about the hotel: {hotel_details}. "
-        f"Do not answer any questions unrelated to your role or the hotel. If a user asks "
-        f"a non-concierge question, politely state that you can only assist with "
-        f"hotel-related inquiries. Keep your responses concise and professional."
+
+    # Hotel-specific details go in a message after SYSTEM_PROMPT so the prompt head stays constant
+    context = (
+        f"A guest has selected {hotel_name} and is ready to chat. You are the concierge for "
+        f"{hotel_name}. You have access to the following information about the hotel: {hotel_details}."
     )
     
-    # Add the constrained prompt to the conversation memory
-    conversation.memory.chat_memory.add_user_message(system_prompt)
-    
     # Optionally add a summary of past chats to the context
     if past_chats:
-        summary = "\n\n".join([f"User said: {c['user_message']}\nBot replied: {c['bot_response']}" for c in past_chats[-5:]])
-        conversation.memory.chat_memory.add_user_message(
-            f"Here's a brief summary of past chats with the user:\n{summary}"
-        )
+        summary = "\n\n".join([f"User said: {c['user_message']}\nBot replied: {c['bot_response']}" for c in past_chats])
+        context += f"\n\nHere's a brief summary of past chats with the user:\n{summary}"
+
+    hotel_context = HumanMessage(content=context)
     
     # Get the AI's first response based on the new constraints
-    initial_ai_response = conversation.predict(input=f"A guest has selected {hotel_name} and is ready to chat.")
-    return initial_ai_response
+    initial_ai_response = await llm.ainvoke([SYSTEM_PROMPT, hotel_context])
+    user_sessions[username] = {
+        "session_id": ObjectId(),
+        "hotel": hotel_name,
+        "messages": [hotel_context, AIMessage(content=initial_ai_response.content)]
+    }
+    return initial_ai_response.content
+
+async def build_conversation_messages(session, message):
+    """
+    Builds the LLM input for a turn: SYSTEM_PROMPT, the session's hotel context exchange, the
+    session's last CONVERSATION_WINDOW concierge turns (oldest first), then the new message.
+    """
+    cursor = history_collection.find(
+        {"session_id": session["session_id"]},
+        {"_id": 0, "user_message": 1, "bot_response": 1}
+    ).sort("timestamp", -1).limit(CONVERSATION_WINDOW)
+    recent = await cursor.to_list(length=CONVERSATION_WINDOW)
+
+    messages = [SYSTEM_PROMPT, *session["messages"]]
+    for entry in reversed(recent):
+        messages.append(HumanMessage(content=entry.get("user_message", "")))
+        messages.append(AIMessage(content=entry.get("bot_response", "")))
+    messages.append(HumanMessage(content=message))
+    return messages
+
+def format_sse(data, event=None):
+    """
+    Formats a Server-Sent Events message. Multi-line data is split across data: fields.
+    """
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+async def stream_reply(username, session, message, messages):
+    """
+    Streams the LLM reply as Server-Sent Events and queues the completed turn for history.
+    """
+    chunks = []
+    try:
+        async for chunk in llm.astream(messages):
+            chunks.append(chunk.content)
+            yield format_sse(chunk.content)
+    except Exception:
+        logging.exception("Chat stream error for user=%s", username)
+        yield format_sse("Error processing your request.", event="error")
+        return
+
+    record_turn(username, session["hotel"], message, "".join(chunks), session["session_id"])
+
+async def handle_turn(username, message, manual_msg):
+    """
+    Shared logic for one /chat or /whatsapp message. Returns (reply, None, None) when the turn
+    is answered directly, or (None, session, messages) with the LLM input when the selected
+    hotel's concierge should answer; the caller then sends it and records the turn.
+    """
+    if not await get_ai_enabled(username):
+        reply = manual_msg
+        logging.info("[DB] Queued chat history for manual response.")
+    elif llm is None:
+        return "AI service is currently unavailable.", None, None
+    # Handle "reset" keywords
+    elif RESET_RE.search(message):
+        user_sessions.pop(username, None)
+        user_selected_hotels.pop(username, None)
+        hotel_list = await get_hotel_list_text()
+        return f"Sure! Please choose a hotel from the following list:{hotel_list}", None, None
+    # The session cache is bounded, so an evicted session means choosing a hotel again
+    elif username not in user_selected_hotels or username not in user_sessions:
+        hotel_data = await find_hotel(message)
+        if hotel_data:
+            # Initialize a new conversation for this user and hotel
+            reply = await initialize_conversation(username, hotel_data, await get_past_chats(username))
+            user_selected_hotels[username] = hotel_data.get("hotel_name", "N/A")
+        else:
+            hotel_list = await get_hotel_list_text()
+            reply = f"Please choose a hotel from the following list:{hotel_list}"
+    else:
+        # Read the session before awaiting; a concurrent reset from the same user may pop it
+        session = user_sessions[username]
+        refresh_session(username)
+        return None, session, await build_conversation_messages(session, message)
+
+    record_turn(username, user_selected_hotels.get(username, "N/A"), message, reply)
+    return reply, None, None
+
+def twiml_response(text):
+    resp = MessagingResponse()
+    resp.message(text)
+    return Response(content=str(resp), media_type="text/xml")
 
 @app.get("/", response_class=HTMLResponse)
 async def root():
@@ -110,12 +374,15 @@ async def root():
 
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return HTMLResponse(login_page_html)
 
 @app.get("/chat", response_class=HTMLResponse)
 async def chat_page(request: Request):
     username = request.query_params.get("username")
-    return templates.TemplateResponse("chat.html", {"request": request, "username": username})
+    return HTMLResponse(
+        chat_template.render(request=request, username=username),
+        headers={"Cache-Control": "private, max-age=60"}
+    )
 
 @app.get("/history", response_class=HTMLResponse)
 async def chat_history_page(request: Request):
@@ -124,52 +391,53 @@ async def chat_history_page(request: Request):
         # Redirect to login if username is not provided (user not logged in)
         return RedirectResponse(url="/login", status_code=303)
 
-    from db import history_collection
     if history_collection is None:
         raise HTTPException(status_code=503, detail="Database history collection not available.")
 
     try:
-        raw_history = list(history_collection.find({"username": username}))
-
-        sorted_history = sorted(raw_history, key=lambda x: x.get("timestamp", datetime.min), reverse=True)
+        cursor = history_collection.find({"username": username}, HISTORY_PROJECTION).sort("timestamp", -1).limit(HISTORY_PAGE_SIZE)
+        sorted_history = await cursor.to_list(length=HISTORY_PAGE_SIZE)
 
-        for entry in sorted_history:
-            if isinstance(entry.get("timestamp"), datetime):
-                entry["timestamp_str"] = entry["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
-            else:
-                entry["timestamp_str"] = "N/A"
-
-        return templates.TemplateResponse("history.html", {"request": request, "username": username, "history": sorted_history})
+        # TemplateResponse renders on construction; do that in the threadpool to keep the loop free
+        return await run_in_threadpool(
+            templates.TemplateResponse, request, "history.html", {"username": username, "history": sorted_history}
+        )
     except Exception as e:
         logging.error(f"Error fetching chat history for {username}: {e}")
         return JSONResponse(status_code=500, content={"error": "Could not retrieve chat history."})
     
-@app.get("/chat/history")
+@app.get("/chat/history", response_model=HistoryPage)
 async def get_chat_history(request: Request):
     username = request.query_params.get("username")
     if not username:
         return JSONResponse(status_code=400, content={"error": "Username is required"})
 
     try:
-        raw_history = list(history_collection.find({"username": username}).sort("timestamp", 1))
-
-        formatted_history = [
-            {
-                "user_message": entry.get("user_message", ""),
-                "bot_response": entry.get("bot_response", ""),
-                "timestamp": entry.get("timestamp").strftime("%Y-%m-%d %H:%M:%S") if entry.get("timestamp") else "N/A"
-            }
-            for entry in raw_history
+        # Take the latest page via the (username, timestamp) index, then return it oldest-first.
+        # Timestamps stay datetimes; HistoryPage serializes them as ISO-8601.
+        pipeline = [
+            {"$match": {"username": username}},
+            {"$sort": {"timestamp": -1}},
+            {"$limit": HISTORY_PAGE_SIZE},
+            {"$sort": {"timestamp": 1}},
+            {"$project": {
+                "_id": 0,
+                "user_message": {"$ifNull": ["$user_message", ""]},
+                "bot_response": {"$ifNull": ["$bot_response", ""]},
+                "timestamp": 1
+            }}
         ]
-        return JSONResponse(content={"history": formatted_history})
+        formatted_history = await history_collection.aggregate(pipeline).to_list(length=HISTORY_PAGE_SIZE)
+        return {"history": formatted_history}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
-@app.post("/chat")
+@app.post("/chat", response_model=ChatReply)
 async def chat(request: Request):
     if history_collection is None:
         raise HTTPException(status_code=503, detail="Database history collection not available.")
 
+    username = None
     try:
         data = await request.json()
         message = data.get("message")
@@ -177,77 +445,22 @@ async def chat(request: Request):
         if not message:
             raise HTTPException(status_code=400, detail="No message provided")
 
-        user = users_collection.find_one({"username": username})
-        ai_enabled = user.get("ai_enabled", True) if user else True
-
-        if not ai_enabled:
-            manual_msg = "The admin will respond to your message shortly."
-            history_collection.insert_one({
-                "username": username,
-                "hotel": user_selected_hotels.get(username, "N/A"),
-                "timestamp": datetime.now(),
-                "user_message": message,
-                "bot_response": manual_msg
-            })
-            logging.info(f"[DB] Inserted chat history for manual response.")
-            return JSONResponse(content={"response": manual_msg})
-
-        # Get or create the conversation for the specific user
-        conversation = get_or_create_conversation(username)
-        if conversation is None:
-            raise HTTPException(status_code=503, detail="AI service not available.")
-
-        reply = ""
-        # Handle "reset" keywords
-        reset_phrases = ["change hotel", "different hotel", "try another hotel", "switch hotel", "reset hotel", "choose hotel again"]
-        if any(phrase in message.lower() for phrase in reset_phrases):
-            if username in user_sessions:
-                del user_sessions[username]
-            if username in user_selected_hotels:
-                del user_selected_hotels[username]
-
-            hotels = list(hotels_collection.find({}, {"hotel_name": 1}))
-            hotel_names = [h["hotel_name"] for h in hotels]
-            hotel_list = "\n- ".join(hotel_names)
-            return JSONResponse(content={"response": f"Sure! Please choose a hotel from the following list:\n- {hotel_list}"})
-
-        # Check if a hotel has been selected for this user
-        if username not in user_selected_hotels:
-            hotel_data = hotels_collection.find_one({"hotel_name": {"$regex": f"^{message}$", "$options": "i"}})
-            if hotel_data:
-                # Initialize a new conversation for this user and hotel
-                reply = initialize_conversation(conversation, hotel_data, list(history_collection.find({"username": username})))
-                user_selected_hotels[username] = hotel_data.get("hotel_name", "N/A")
-            else:
-                hotels = list(hotels_collection.find({}, {"hotel_name": 1}))
-                hotel_names = [h["hotel_name"] for h in hotels]
-                hotel_list = "\n- ".join(hotel_names)
-                reply = f"Please choose a hotel from the following list:\n- {hotel_list}"
-        
-        if not reply:
-            reply = conversation.predict(input=message)
-
-        history_collection.insert_one({
-            "username": username,
-            "hotel": user_selected_hotels.get(username, "N/A"),
-            "timestamp": datetime.now(),
-            "user_message": message,
-            "bot_response": reply
-        })
-
-        users_collection.update_one(
-            {"username": username},
-            {
-                "$set": {"last_active": datetime.utcnow()},
-                "$setOnInsert": {"ai_enabled": True}
-            },
-            upsert=True
-        )
+        reply, session, messages = await handle_turn(username, message, "The admin will respond to your message shortly.")
+        if reply is not None:
+            return {"response": reply}
 
-        return JSONResponse(content={"response": reply})
+        # Stream the LLM reply so the first tokens reach the client without waiting for the rest
+        return StreamingResponse(
+            stream_reply(username, session, message, messages),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
 
+    except HTTPException:
+        # Client errors such as an empty message keep their status and aren't logged as failures
+        raise
     except Exception as e:
-        logging.error(f"Chat error: {e}")
+        logging.exception("Chat error for user=%s", username)
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.post("/whatsapp", response_class=PlainTextResponse)
@@ -259,95 +472,30 @@ async def whatsapp_webhook(
     username = From
 
     if history_collection is None:
-        resp = MessagingResponse()
-        resp.message("History system is currently unavailable.")
-        return Response(content=str(resp), media_type="text/xml")
+        return twiml_response("History system is currently unavailable.")
 
     try:
-        user = users_collection.find_one({"username": username})
-        ai_enabled = user.get("ai_enabled", True) if user else True
-
-        if not ai_enabled:
-            manual_msg = "Thank you for your message. The admin will respond to you shortly."
-            history_collection.insert_one({
-                "username": username,
-                "timestamp": datetime.now(),
-                "user_message": user_message,
-                "bot_response": manual_msg
-            })
-            resp = MessagingResponse()
-            resp.message(manual_msg)
-            return Response(content=str(resp), media_type="text/xml")
-
-        # Get or create the conversation for the specific user
-        conversation = get_or_create_conversation(username)
-        if conversation is None:
-            resp = MessagingResponse()
-            resp.message("AI service is currently unavailable.")
-            return Response(content=str(resp), media_type="text/xml")
-
-        bot_reply = ""
-        # Handle "reset" keywords
-        reset_phrases = ["change hotel", "different hotel", "try another hotel", "switch hotel", "reset hotel", "choose hotel again"]
-        if any(phrase in user_message.lower() for phrase in reset_phrases):
-            if username in user_sessions:
-                del user_sessions[username]
-            if username in user_selected_hotels:
-                del user_selected_hotels[username]
-
-            hotels = list(hotels_collection.find({}, {"hotel_name": 1}))
-            hotel_names = [h["hotel_name"] for h in hotels]
-            hotel_list = "\n- ".join(hotel_names)
-
-            bot_reply = f"Sure! Please choose a hotel from the following list:\n- {hotel_list}"
-            resp = MessagingResponse()
-            resp.message(bot_reply)
-            return Response(content=str(resp), media_type="text/xml")
-
-        if username not in user_selected_hotels:
-            hotel_data = hotels_collection.find_one({"hotel_name": {"$regex": f"^{user_message}$", "$options": "i"}})
-            if hotel_data:
-                # Initialize a new conversation for this user and hotel
-                bot_reply = initialize_conversation(conversation, hotel_data, list(history_collection.find({"username": username})))
-                user_selected_hotels[username] = hotel_data.get("hotel_name", "N/A")
-                resp = MessagingResponse()
-                resp.message(bot_reply)
-                return Response(content=str(resp), media_type="text/xml")
-            else:
-                hotels = list(hotels_collection.find({}, {"hotel_name": 1}))
-                hotel_names = [h["hotel_name"] for h in hotels]
-                hotel_list = "\n- ".join(hotel_names)
-                bot_reply = f"Please choose a hotel from the following list:\n- {hotel_list}"
-                resp = MessagingResponse()
-                resp.message(bot_reply)
-                return Response(content=str(resp), media_type="text/xml")
-
-        if not bot_reply:
-            bot_reply = conversation.predict(input=user_message)
-
-        history_collection.insert_one({
-            "username": username,
-            "hotel": user_selected_hotels.get(username, "N/A"),
-            "timestamp": datetime.now(),
-            "user_message": user_message,
-            "bot_response": bot_reply
-        })
-
-        users_collection.update_one(
-            {"username": username},
-            {
-                "$set": {"last_active": datetime.utcnow()},
-                "$setOnInsert": {"ai_enabled": True}
-            },
-            upsert=True
-        )
-
-        resp = MessagingResponse()
-        resp.message(bot_reply)
-        return Response(content=str(resp), media_type="text/xml")
-
-    except Exception as e:
-        logging.error(f"WhatsApp message error: {e}")
-        resp = MessagingResponse()
-        resp.message("An error occurred. Please try again later.")
-        return Response(content=str(resp), media_type="text/xml")
+        manual_msg = "Thank you for your message. The admin will respond to you shortly."
+        bot_reply, session, messages = await handle_turn(username, user_message, manual_msg)
+        if bot_reply is None:
+            bot_reply = (await llm.ainvoke(messages)).content
+            record_turn(username, session["hotel"], user_message, bot_reply, session["session_id"])
+
+        return twiml_response(bot_reply)
+
+    except Exception:
+        logging.exception("WhatsApp message error for user=%s", username)
+        return twiml_response("An error occurred. Please try again later.")
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Session state lives in this process, so extra workers (WEB_CONCURRENCY) need sticky routing.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools"
+    )
@@ -1,5 +1,19 @@
 # A simple in-memory store for user-specific data.
 # In a production environment, this would be a more persistent cache like Redis or a database.
+from cachetools import TTLCache
 
-user_sessions = {}
-user_selected_hotels = {}
+# Session state is bounded and expires after an hour without a chat turn, so idle users don't
+# accumulate forever. It is per process: with several workers, run them behind sticky routing.
+
+# username -> {session_id, hotel, messages}: the hotel context exchange for the current visit.
+# Chat turns themselves live in Mongo, tagged with session_id.
+user_sessions = TTLCache(maxsize=10_000, ttl=3600)
+# username -> name of the user's selected hotel
+user_selected_hotels = TTLCache(maxsize=10_000, ttl=3600)
+
+# Short-lived cache of user documents (password hash only) looked up by auth.
+user_cache = TTLCache(maxsize=10_000, ttl=60)
+
+# username -> ai_enabled flag, so repeat messages skip the users read. Anything that toggles
+# the flag should pop the entry; otherwise the change takes effect within the TTL.
+ai_enabled_cache = TTLCache(maxsize=10_000, ttl=30)